@@ -3,24 +3,100 @@ In this module, we do some of the preparatory work that is needed to get
 CoolProp ready to build.  This includes setting the correct versions in the
 headers, generating the fluid files, etc.
 """
-from __future__ import division, print_function, unicode_literals
-from datetime import datetime
 import subprocess
+import contextlib
 import os
 import sys
+import re
+import mmap
 import json
 import hashlib
 import struct
-import glob
+import itertools
+import functools
 
 json_options = {'indent': 2, 'sort_keys': True}
 
 
+def json_dumps(obj, verbose=False):
+    """
+    Serialize to JSON bytes; verbose output is indented and has sorted keys,
+    as per json_options
+    """
+    if verbose:
+        return json.dumps(obj, **json_options).encode('utf-8')
+    return json.dumps(obj).encode('utf-8')
+
+
+@functools.lru_cache(maxsize=None)
 def get_hash(data):
+    """
+    Memoized SHA-224 hex digest of short bytes, used for the version and git
+    revision strings
+    """
+    return hashlib.sha224(data).hexdigest()
+
+
+def file_hash(path):
+    """
+    SHA-224 hex digest of a file, hashed from a memory map of the file rather
+    than from a copy of its contents
+    """
+    with open(path, 'rb') as fp:
+        # Empty files cannot be memory mapped
+        if os.fstat(fp.fileno()).st_size == 0:
+            return hashlib.sha224(b'').hexdigest()
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return hashlib.sha224(m).hexdigest()
+
+
+def atomic_write(path, data):
+    """
+    Write bytes, or an iterable of bytes chunks, to a temporary file that is
+    then renamed over path, so that a partially written file is never left
+    behind.  If path already holds the same data it is not touched, so that
+    its modification time does not trigger rebuilds.  Returns the SHA-224
+    hex digest of the data
+    """
+    if isinstance(data, bytes):
+        data = [data]
+    tmp_path = path + '.tmp'
+    h = hashlib.sha224()
+    size = 0
     try:
-        return hashlib.sha224(data).hexdigest()
-    except TypeError:
-        return hashlib.sha224(data.encode('ascii')).hexdigest()
+        with open(tmp_path, 'wb') as fp:
+            for chunk in data:
+                fp.write(chunk)
+                h.update(chunk)
+                size += len(chunk)
+    except BaseException:
+        # The temporary file does not exist if it could not be opened
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+    digest = h.hexdigest()
+
+    if os.path.isfile(path) and os.path.getsize(path) == size and file_hash(path) == digest:
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+    return digest
+
+
+class HashStore(dict):
+    """
+    The hashes of the data written to each file.  dirty is only set when an
+    entry is added or changed, so that an unchanged store need not be written
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.dirty = False
+
+    def __setitem__(self, key, value):
+        if key not in self or self[key] != value:
+            self.dirty = True
+        dict.__setitem__(self, key, value)
 
 
 # unicode
@@ -29,9 +105,9 @@ repo_root_path = os.path.normpath(os.path.join(os.path.abspath(__file__), '..',
 # Load up the hashes of the data that will be written to each file
 hashes_fname = os.path.join(repo_root_path, 'dev', 'hashes.json')
 if os.path.exists(hashes_fname):
-    hashes = json.load(open(hashes_fname, 'r'))
+    hashes = HashStore(json.load(open(hashes_fname, 'r')))
 else:
-    hashes = dict()
+    hashes = HashStore()
 
 # 0: Input file path relative to dev folder
 # 1: Output file path relative to include folder
@@ -54,68 +130,84 @@ def TO_CPP(root_dir, hashes):
     def to_chunks(l, n):
         if n < 1:
             n = 1
-        return [l[i:i + n] for i in range(0, len(l), n)]
+        # Stride over a memoryview so that neither the list of chunks nor
+        # copies of the chunks are ever made
+        view = memoryview(l)
+        for i in range(0, len(view), n):
+            yield view[i:i + n]
+
+    # The C-array token of each byte value
+    hex_tokens = ['0x{:02x}'.format(i) for i in range(256)]
+
+    def to_hex_lines(chunks):
+        # The tokens are looked up and joined in C, there is no Python-level
+        # operation per byte; the lines are joined with commas and EOL
+        sep = ''
+        for chunk in chunks:
+            yield (sep + ', '.join(map(hex_tokens.__getitem__, chunk))).encode('ascii')
+            sep = ',\n'
 
     # Normalise path name
     root_dir = os.path.normpath(root_dir)
 
     # First we package up the JSON files
-    combine_json(root_dir)
+    combine_json(root_dir, hashes)
 
     for infile, outfile, variable in values:
 
-        import json
+        # Read the JSON file once; the same bytes are validated and encoded
+        json_ = open(os.path.join(root_dir, 'dev', infile), 'rb').read()
 
-        # Confirm that the JSON file can be loaded and doesn't have any formatting problems
-        with open(os.path.join(root_dir, 'dev', infile), 'r') as fp:
+        # The hex array is a pure function of the JSON bytes, so hash those
+        # rather than the (roughly 6x larger) generated text
+        json_hash = hashlib.sha224(json_).hexdigest()
+
+        outpath = os.path.join(root_dir, 'include', outfile)
+
+        # Check if hash is up to date based on using variable as key; entries
+        # hold the hashes of both the source JSON and the generated header, so
+        # that a header that was replaced or edited on disk is also regenerated
+        if not os.path.isfile(outpath) or not isinstance(hashes.get(variable), dict) or hashes[variable].get('src_sha224') != json_hash or file_hash(outpath) != hashes[variable].get('out_sha224'):
+
+            # Confirm that the JSON file can be loaded and doesn't have any formatting problems
             try:
-                jj = json.load(fp)
+                json.loads(json_)
             except ValueError:
                 file = os.path.join(root_dir, 'dev', infile)
                 print('"python -mjson.tool ' + file + '" returns ->', end='')
                 subprocess.call('python -mjson.tool ' + file, shell=True)
                 raise ValueError('unable to decode file %s' % file)
 
-        json = open(os.path.join(root_dir, 'dev', infile), 'r').read().encode('ascii')
-
-        # convert each character to hex and add a terminating NULL character to end the
-        # string, join into a comma separated string
-
-        try:
-            h = ["0x{:02x}".format(ord(b)) for b in json] + ['0x00']
-        except TypeError:
-            h = ["0x{:02x}".format(int(b)) for b in json] + ['0x00']
-
-        # Break up the file into lines of 16 hex characters
-        chunks = to_chunks(h, 16)
-
-        # Put the lines back together again
-        # The chunks are joined together with commas, and then EOL are used to join the rest
-        hex_string = ',\n'.join([', '.join(chunk) for chunk in chunks])
+            # Add a terminating NULL character to end the string and break up the
+            # file into lines of 16 bytes
+            chunks = to_chunks(json_ + b'\x00', 16)
 
-        # Check if hash is up to date based on using variable as key
-        if not os.path.isfile(os.path.join(root_dir, 'include', outfile)) or variable not in hashes or (variable in hashes and hashes[variable] != get_hash(hex_string.encode('ascii'))):
+            # Generate the output strings around the array
+            # No timestamp, so that regenerating unchanged data leaves the file untouched
+            prefix = '// File generated by the script dev/generate_headers.py\n\n'
+            prefix += '// JSON file encoded in binary form\n'
+            prefix += 'const unsigned char ' + variable + '_binary[] = {\n'
+            suffix = '\n};' + '\n\n'
+            suffix += '// Combined into a single std::string \n'
+            suffix += 'std::string {v:s}({v:s}_binary, {v:s}_binary + sizeof({v:s}_binary)/sizeof({v:s}_binary[0]));'.format(v=variable)
 
-            # Generate the output string
-            output = '// File generated by the script dev/generate_headers.py on ' + str(datetime.now()) + '\n\n'
-            output += '// JSON file encoded in binary form\n'
-            output += 'const unsigned char ' + variable + '_binary[] = {\n' + hex_string + '\n};' + '\n\n'
-            output += '// Combined into a single std::string \n'
-            output += 'std::string {v:s}({v:s}_binary, {v:s}_binary + sizeof({v:s}_binary)/sizeof({v:s}_binary[0]));'.format(v=variable)
+            # Stream the lines into the file as they are converted to hex, so the
+            # array is never held in memory
+            output = itertools.chain([prefix.encode('ascii')], to_hex_lines(chunks), [suffix.encode('ascii')])
+            out_hash = atomic_write(outpath, output)
 
-            # Write it to file
-            f = open(os.path.join(root_dir, 'include', outfile), 'w')
-            f.write(output)
-            f.close()
+            # Store the hashes of the JSON data and of what was written to file
+            hashes[variable] = {'src_sha224': json_hash, 'out_sha224': out_hash}
 
-            # Store the hash of the data that was written to file (not including the header)
-            hashes[variable] = get_hash(hex_string.encode('ascii'))
-
-            print(os.path.join(root_dir, 'include', outfile) + ' written to file')
+            print(outpath + ' written to file')
         else:
             print(outfile + ' is up to date')
 
 
+# Matches the set(... VERSION_XXX value) lines in CMakeLists.txt
+version_regex = re.compile(r'VERSION_(MAJOR|MINOR|PATCH|REVISION)[ \t]*([^\s)]*)[ \t]*\)')
+
+
 def version_to_file(root_dir):
 
     # Parse the CMakeLists.txt file to generate the version
@@ -128,26 +220,21 @@ def version_to_file(root_dir):
     "
     """
 
-    lines = open(os.path.join(root_dir, 'CMakeLists.txt'), 'r').readlines()
-    # Find the necessary lines
-    MAJOR_line = [line for line in lines if ('VERSION_MAJOR' in line and 'MINOR' not in line)]
-    MINOR_line = [line for line in lines if ('VERSION_MINOR' in line and 'MAJOR' not in line)]
-    PATCH_line = [line for line in lines if ('VERSION_PATCH' in line and 'MINOR' not in line)]
-    REVISION_line = [line for line in lines if ('VERSION_REVISION' in line and 'MINOR' not in line)]
-    # String processing
-    MAJOR = MAJOR_line[0].strip().split('VERSION_MAJOR')[1].split(')')[0].strip()
-    MINOR = MINOR_line[0].strip().split('VERSION_MINOR')[1].split(')')[0].strip()
-    PATCH = PATCH_line[0].strip().split('VERSION_PATCH')[1].split(')')[0].strip()
-    REVISION = REVISION_line[0].strip().split('VERSION_REVISION')[1].split(')')[0].strip()
+    text = open(os.path.join(root_dir, 'CMakeLists.txt'), 'r').read()
+    # Find the necessary values in a single pass; only the first definition of
+    # each is used.  The revision can be empty
+    parts = {}
+    for key, value in version_regex.findall(text):
+        parts.setdefault(key, value)
     # Generate the strings
-    version = '.'.join([MAJOR, MINOR, PATCH]) + REVISION
+    version = '.'.join([parts['MAJOR'], parts['MINOR'], parts['PATCH']]) + parts['REVISION']
 
     # Get the hash of the version
     if 'version' not in hashes or ('version' in hashes and hashes['version'] != get_hash(version.encode('ascii'))):
-        hashes['version'] = get_hash(version)
+        hashes['version'] = get_hash(version.encode('ascii'))
 
         # Format the string to be written
-        string_for_file = '//Generated by the generate_headers.py script on {t:s}\n\nstatic char version [] ="{v:s}";'.format(t=str(datetime.now()), v=version)
+        string_for_file = '//Generated by the generate_headers.py script\n\nstatic char version [] ="{v:s}";'.format(v=version)
 
         # Include path relative to the root
         include_dir = os.path.join(root_dir, 'include')
@@ -156,9 +243,7 @@ def version_to_file(root_dir):
         file_name = os.path.join(include_dir, 'cpversion.h')
 
         # Write to file
-        f = open(file_name, 'w')
-        f.write(string_for_file)
-        f.close()
+        atomic_write(file_name, string_for_file.encode('ascii'))
 
         print('version written to file: ' + file_name)
 
@@ -168,9 +253,7 @@ def version_to_file(root_dir):
     hidden_file_name = os.path.join(root_dir, '.version')
 
     # Write to file
-    f = open(hidden_file_name, 'w')
-    f.write(version)
-    f.close()
+    atomic_write(hidden_file_name, version.encode('ascii'))
 
     print('version written to hidden file: ' + hidden_file_name + " for use in builders that don't use git repo")
 
@@ -183,17 +266,15 @@ def gitrev_to_file(root_dir):
 
     try:
         try:
-            subprocess.check_call('git --version', shell=True)
-            print('git is accessible at the command line')
-
-            # Try to get the git revision
-            p = subprocess.Popen('git rev-parse HEAD',
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             shell=True,
-                             cwd=os.path.abspath(os.path.dirname(__file__)))
-            stdout, stderr = p.communicate()
-            stdout = stdout.decode('utf-8')
+            # Try to get the git revision; git is run directly rather than through
+            # a shell, and a missing git shows up as FileNotFoundError
+            p = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               cwd=os.path.abspath(os.path.dirname(__file__)),
+                               timeout=5,
+                               check=False)
+            stdout = p.stdout.decode('utf-8')
 
             if p.returncode != 0:
                 print('tried to get git revision from git, but could not (building from zip file?)')
@@ -209,26 +290,27 @@ def gitrev_to_file(root_dir):
                 is_hash = not ' ' in gitrev
 
                 if not is_hash:
-                    raise ValueError('No hash returned from call to git, got ' + rev + ' instead')
+                    raise ValueError('No hash returned from call to git, got ' + gitrev + ' instead')
 
-        except subprocess.CalledProcessError:
+        except FileNotFoundError:
             print('git was not found')
             gitrev = '???'
+        except subprocess.TimeoutExpired:
+            print('git did not return the git revision in time')
+            gitrev = '???'
 
         # Include path relative to the root
         include_dir = os.path.join(root_dir, 'include')
 
         print('git revision is', str(gitrev))
 
-        if 'gitrevision' not in hashes or ('gitrevision' in hashes and hashes['gitrevision'] != get_hash(gitrev)):
+        if 'gitrevision' not in hashes or ('gitrevision' in hashes and hashes['gitrevision'] != get_hash(gitrev.encode('ascii'))):
             print('*** Generating gitrevision.h ***')
-            gitstring = '//Generated by the generate_headers.py script on {t:s}\n\nstd::string gitrevision = \"{rev:s}\";'.format(t=str(datetime.now()), rev=gitrev)
+            gitstring = '//Generated by the generate_headers.py script\n\nstd::string gitrevision = \"{rev:s}\";'.format(rev=gitrev)
 
-            f = open(os.path.join(include_dir, 'gitrevision.h'), 'w')
-            f.write(gitstring)
-            f.close()
+            atomic_write(os.path.join(include_dir, 'gitrevision.h'), gitstring.encode('ascii'))
 
-            hashes['gitrevision'] = get_hash(gitrev)
+            hashes['gitrevision'] = get_hash(gitrev.encode('ascii'))
             print(os.path.join(include_dir, 'gitrevision.h') + ' written to file')
         else:
             print('gitrevision.h is up to date')
@@ -237,57 +319,67 @@ def gitrev_to_file(root_dir):
         print('err:', err)
 
 
-def combine_json(root_dir):
-
-    master = []
+def _load_json(file):
+    """
+    Load one fluid file and serialize it in the compact and verbose forms used
+    by combine_json
+    """
+    try:
+        fluid = json.loads(open(file, 'rb').read())
+    except ValueError:
+        print('"python -mjson.tool ' + file + '" returns ->', end='')
+        subprocess.call('python -mjson.tool ' + file, shell=True)
+        raise ValueError('unable to decode file %s' % file)
 
-    for file in glob.glob(os.path.join(root_dir, 'dev', 'fluids', '*.json')):
+    # The verbose form is indented one more level since it is an element of
+    # the combined list; JSON strings cannot contain a raw EOL
+    return json_dumps(fluid), b'  ' + json_dumps(fluid, verbose=True).replace(b'\n', b'\n  ')
 
-        path, file_name = os.path.split(file)
-        fluid_name = file_name.split('.')[0]
 
-        try:
-            # Load the fluid file
-            fluid = json.load(open(file, 'r'))
-        except ValueError:
-            print('"python -mjson.tool ' + file + '" returns ->', end='')
-            subprocess.call('python -mjson.tool ' + file, shell=True)
-            raise ValueError('unable to decode file %s' % file)
+def _sources_signature(entries):
+    """
+    Hash of the names, sizes and modification times of the source files (as
+    os.DirEntry), so that unchanged sources can be detected without reading
+    or parsing them
+    """
+    stats = []
+    for entry in entries:
+        st = entry.stat()
+        stats.append('{0:s}\t{1:d}\t{2:d}'.format(entry.name, st.st_size, st.st_mtime_ns))
+    return hashlib.sha224('\n'.join(stats).encode('utf-8')).hexdigest()
 
-        master += [fluid]
 
-    fp = open(os.path.join(root_dir, 'dev', 'all_fluids_verbose.json'), 'w')
-    fp.write(json.dumps(master, **json_options))
-    fp.close()
+def combine_json(root_dir, hashes):
 
-    fp = open(os.path.join(root_dir, 'dev', 'all_fluids.json'), 'w')
-    fp.write(json.dumps(master))
-    fp.close()
+    # 0: Source folder relative to dev folder
+    # 1: Name of the combined files in the dev folder
+    for folder, name in [(('fluids',), 'all_fluids'), (('incompressible_liquids', 'json'), 'all_incompressibles')]:
 
-    master = []
+        # Sorted so that the order of the combined file is deterministic; the
+        # entries from scandir carry their path and cache their stat results
+        entries = sorted((entry for entry in os.scandir(os.path.join(root_dir, 'dev', *folder)) if entry.name.endswith('.json') and entry.is_file()), key=lambda entry: entry.name)
+        verbose_path = os.path.join(root_dir, 'dev', name + '_verbose.json')
+        path = os.path.join(root_dir, 'dev', name + '.json')
 
-    for file in glob.glob(os.path.join(root_dir, 'dev', 'incompressible_liquids', 'json', '*.json')):
+        # Skip loading the files entirely if none of them changed since the last run
+        signature = _sources_signature(entries)
+        if os.path.isfile(verbose_path) and os.path.isfile(path) and hashes.get(name + '_sources') == signature:
+            print(name + '.json is up to date')
+            continue
 
-        path, file_name = os.path.split(file)
-        fluid_name = file_name.split('.')[0]
+        # Load and serialize each fluid file; the bytes are spliced together into
+        # the combined lists rather than building and serializing the list of all fluids
+        parts = [_load_json(entry.path) for entry in entries]
+        compact = [part[0] for part in parts]
+        verbose = [part[1] for part in parts]
 
-        try:
-            # Load the fluid file
-            fluid = json.load(open(file, 'r'))
-        except ValueError:
-            print('"python -mjson.tool ' + file + '" returns ->', end='')
-            subprocess.call('python -mjson.tool ' + file, shell=True)
-            raise ValueError('unable to decode file %s' % file)
+        atomic_write(verbose_path, b'[\n' + b',\n'.join(verbose) + b'\n]' if verbose else b'[]')
 
-        master += [fluid]
+        # Same item separator as json.dumps uses for compact output
+        atomic_write(path, b'[' + b', '.join(compact) + b']')
 
-    fp = open(os.path.join(root_dir, 'dev', 'all_incompressibles_verbose.json'), 'w')
-    fp.write(json.dumps(master, **json_options))
-    fp.close()
+        hashes[name + '_sources'] = signature
 
-    fp = open(os.path.join(root_dir, 'dev', 'all_incompressibles.json'), 'w')
-    fp.write(json.dumps(master))
-    fp.close()
 
 
 def generate():
@@ -302,11 +394,10 @@ def generate():
 
     TO_CPP(root_dir=repo_root_path, hashes=hashes)
 
-    # Write the hashes to a hashes JSON file
-    if hashes:
-        fp = open(hashes_fname, 'w')
-        fp.write(json.dumps(hashes))
-        fp.close()
+    # Write the hashes to a hashes JSON file if any of them changed; the keys
+    # are sorted so that the same hashes always give the same file
+    if hashes.dirty:
+        atomic_write(hashes_fname, json_dumps(hashes, verbose=True))
 
 
 if __name__ == '__main__':